@@ -4,25 +4,32 @@ Downloads Google's AudioSet dataset locally
 """
 import argparse
 import atexit
-import collections
-import csv
+import collections.abc
+import itertools
+import json
 import logging.handlers
-import multiprocessing as mp
+import operator
 import os
 import random
 import shutil
+import subprocess as sp
 import sys
+import tempfile
+import threading
+import time
 import traceback as tb
-import urllib.request
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
-import multiprocessing_logging
-import pafy
+import urllib3
+import yt_dlp
 
-from errors import SubprocessError, FfmpegValidationError, FfmpegIncorrectDurationError
-from log import init_file_logger, init_console_logger
+from errors import SubprocessError, FfmpegValidationError, \
+    FfmpegIncorrectDurationError, SubsetFileError, SegmentDownloadError
+from log import init_file_logger, init_console_logger, init_queue_logger
 from utils import run_command, is_url, get_filename, \
-    get_subset_name, get_media_filename, HTTP_ERR_PATTERN
+    get_subset_name, get_media_filename, get_media_filepaths, \
+    iter_subset_segments, move_file, HTTP_ERR_PATTERN
 from validation import validate_audio, validate_video
 
 LOGGER = logging.getLogger('audiosetdl')
@@ -32,6 +39,48 @@ EVAL_URL = 'http://storage.googleapis.com/us_audioset/youtube_corpus/v1/csv/eval
 BALANCED_TRAIN_URL = 'http://storage.googleapis.com/us_audioset/youtube_corpus/v1/csv/balanced_train_segments.csv'
 UNBALANCED_TRAIN_URL = 'http://storage.googleapis.com/us_audioset/youtube_corpus/v1/csv/unbalanced_train_segments.csv'
 
+# Size of the chunks in which subset files are copied to disk
+COPY_BUFFER_SIZE = 1 << 20
+
+# Stream URLs obtained from YouTube expire after about 6 hours
+YT_URL_TTL = 4 * 60 * 60
+
+# Number of videos whose info is kept in memory
+YT_INFO_CACHE_SIZE = 256
+
+YDL_OPTS = {
+    'quiet': True,
+    'no_warnings': True,
+    'skip_download': True,
+}
+
+# Input options for stream URLs. The seek is already given as an input option,
+# so ffmpeg issues a ranged request for the segment rather than reading from
+# the start of the stream; these let it recover from dropped connections and
+# reuse the connection for subsequent requests.
+HTTP_INPUT_ARGS = ['-reconnect', '1',
+                   '-reconnect_streamed', '1',
+                   '-reconnect_delay_max', '5',
+                   '-multiple_requests', '1']
+
+# Number of jobs that may wait in the thread pool queue for each worker
+MAX_PENDING_PER_WORKER = 2
+
+# Interval (in seconds) between progress reports
+PROGRESS_INTERVAL = 10
+
+# Connection pool shared by all subset file downloads, so that connections to
+# the AudioSet storage host are kept alive between files. Responses may be
+# gzip-compressed, and are decompressed as they are streamed to disk.
+HTTP = urllib3.PoolManager(retries=urllib3.Retry(3, backoff_factor=0.3),
+                           headers={'Accept-Encoding': 'gzip'})
+
+_THREAD_LOCAL = threading.local()
+
+# Number of segments processed by the workers, and how many of them failed
+_PROGRESS_LOCK = threading.Lock()
+_PROGRESS = {'processed': 0, 'failed': 0}
+
 
 def parse_arguments():
     """
@@ -168,7 +217,27 @@ def parse_arguments():
                         action='store',
                         type=int,
                         default=4,
-                        help='Number of multiprocessing workers used to download videos')
+                        help='Number of worker threads used to download videos')
+
+    parser.add_argument('-mc',
+                        '--metadata-cache-dir',
+                        dest='metadata_cache_dir',
+                        action='store',
+                        type=str,
+                        default=None,
+                        help='Directory where resolved YouTube stream URLs are ' \
+                             'cached between runs. By default, no cache is used.')
+
+    parser.add_argument('-sd',
+                        '--scratch-dir',
+                        dest='scratch_dir',
+                        action='store',
+                        type=str,
+                        default=None,
+                        help='Directory (e.g. on a tmpfs such as /dev/shm) where ' \
+                             'ffmpeg writes its outputs before they are moved ' \
+                             'into the data directory. By default, outputs are ' \
+                             'written to the data directory directly.')
 
     parser.add_argument('-nl',
                         '--no-logging',
@@ -190,7 +259,8 @@ def parse_arguments():
                         dest='verbose',
                         action='store_true',
                         default=False,
-                        help='Prints verbose info to stdout')
+                        help='Prints verbose info to stdout. Debug info is ' \
+                             'only written to the log file if this is set.')
 
     parser.add_argument('data_dir',
                         action='store',
@@ -207,32 +277,47 @@ def ffmpeg(ffmpeg_path, input_path, output_path, input_args=None,
     """
     Transform an input file using `ffmpeg`
 
+    Multiple output files can be produced by a single `ffmpeg` invocation by
+    passing a list of output paths. In that case `output_args`,
+    `validation_callback` and `validation_args` must be lists with one entry
+    per output file.
+
     Args:
-        ffmpeg_path:  Path to ffmpeg executable
-                      (Type: str)
+        ffmpeg_path:          Path to ffmpeg executable
+                              (Type: str)
 
-        input_path:   Path/URL to input file(s)
-                      (Type: str or iterable)
+        input_path:           Path/URL to input file(s)
+                              (Type: str or iterable)
 
-        output_path:  Path/URL to output file
-                      (Type: str)
+        output_path:          Path/URL to output file(s)
+                              (Type: str or iterable)
 
-        input_args:   Options/flags for input files
-                      (Type: list[str])
+        input_args:           Options/flags for input files
+                              (Type: list[str])
 
-        output_args:  Options/flags for output files
-                      (Type: list[str])
+        output_args:          Options/flags for output file(s)
+                              (Type: list[str] or list[list[str]])
 
-        log_level:    ffmpeg logging level
-                      (Type: str)
+        log_level:            ffmpeg logging level
+                              (Type: str)
+
+        num_retries:          Number of retries if ffmpeg encounters an HTTP issue
+                              (Type: int)
 
-        num_retries:  Number of retries if ffmpeg encounters an HTTP issue
-                      (Type: int)
+        validation_callback:  Function(s) used to validate output file(s)
+                              (Type: callable or list[callable])
+
+        validation_args:      Keyword arguments for validation function(s)
+                              (Type: dict[str, *] or list[dict[str, *]])
+
+    Returns:
+        success:  True if the output file(s) were produced and validated
+                  (Type: bool)
     """
 
     if type(input_path) == str:
         inputs = ['-i', input_path]
-    elif isinstance(input_path, collections.Iterable):
+    elif isinstance(input_path, collections.abc.Iterable):
         inputs = []
         for path in input_path:
             inputs.append('-i')
@@ -241,63 +326,239 @@ def ffmpeg(ffmpeg_path, input_path, output_path, input_args=None,
         error_msg = '"input_path" must be a str or an iterable, but got type {}'
         raise ValueError(error_msg.format(str(type(input_path))))
 
+    if type(output_path) == str:
+        output_paths = [output_path]
+        output_args = [output_args]
+        validation_callbacks = [validation_callback]
+        validation_args = [validation_args]
+    elif isinstance(output_path, collections.abc.Iterable):
+        output_paths = list(output_path)
+        num_outputs = len(output_paths)
+        output_args = output_args or [None] * num_outputs
+        validation_callbacks = validation_callback or [None] * num_outputs
+        validation_args = validation_args or [None] * num_outputs
+    else:
+        error_msg = '"output_path" must be a str or an iterable, but got type {}'
+        raise ValueError(error_msg.format(str(type(output_path))))
+
     if not input_args:
         input_args = []
-    if not output_args:
-        output_args = []
+    output_args = [args or [] for args in output_args]
+
+    def remove_outputs():
+        for path in output_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Build the command once, and record where the duration values are so that
+    # they can be adjusted between attempts
+    args = [ffmpeg_path] + input_args + inputs
+    input_duration_idx = input_args.index('-t') + 2 if '-t' in input_args else None
+    output_duration_idxs = {}
+    for path, out_args in zip(output_paths, output_args):
+        if '-t' in out_args:
+            output_duration_idxs[path] = len(args) + out_args.index('-t') + 1
+        args += out_args + [path]
+    args += ['-loglevel', log_level]
 
     last_err = None
     for attempt in range(num_retries):
         try:
-            args = [ffmpeg_path] + input_args + inputs + output_args + [output_path, '-loglevel', log_level]
-            run_command(args)
+            try:
+                # ffmpeg only writes to its output files, so discard its stdout
+                run_command(args, stdout=sp.DEVNULL)
+            except SubprocessError as e:
+                if not e.cmd_stderr.rstrip().endswith('already exists. Exiting.'):
+                    raise
+                # The existing output may be a partial file, so it is validated
+                # like a new one rather than trusted
+                LOGGER.info('ffmpeg output file "%s" already exists.', output_path)
 
             # Validate if a callback was passed in
-            if validation_callback is not None:
-                validation_args = validation_args or {}
-                validation_callback(output_path, **validation_args)
-            break
+            for path, callback, callback_args in zip(output_paths,
+                                                     validation_callbacks,
+                                                     validation_args):
+                if callback is not None:
+                    callback(path, **(callback_args or {}))
+            return True
         except SubprocessError as e:
             last_err = e
             stderr = e.cmd_stderr.rstrip()
-            if stderr.endswith('already exists. Exiting.'):
-                LOGGER.info('ffmpeg output file "{}" already exists.'.format(output_path))
-                break
-            elif HTTP_ERR_PATTERN.match(stderr):
-                # Retry if we got a 4XX or 5XX, in case it was just a network issue
-                continue
-
-            LOGGER.error(str(e) + '. Retrying...')
-            if os.path.exists(output_path):
-                os.remove(output_path)
+            if HTTP_ERR_PATTERN.search(stderr.rsplit('\n', 1)[-1]):
+                # Retry if we got a 4XX or 5XX, in case it was just a network
+                # issue. ffmpeg may have written part of the output already.
+                LOGGER.warning('%s. Retrying...', e)
+            else:
+                LOGGER.error('%s. Retrying...', e)
+            remove_outputs()
 
         except FfmpegIncorrectDurationError as e:
             last_err = e
-            if attempt < num_retries - 1 and os.path.exists(output_path):
-                os.remove(output_path)
+            if attempt < num_retries - 1:
+                remove_outputs()
             # If the duration of the output audio is different, alter the
             # duration argument to account for this difference and try again
             duration_diff = e.target_duration - e.actual_duration
-            try:
-                duration_idx = input_args.index('-t') + 1
-                input_args[duration_idx] = str(float(input_args[duration_idx]) + duration_diff)
-            except ValueError:
-                duration_idx = output_args.index('-t') + 1
-                output_args[duration_idx] = str(float(output_args[duration_idx]) + duration_diff)
+            if input_duration_idx is not None:
+                duration_idx = input_duration_idx
+            else:
+                duration_idx = output_duration_idxs[e.filepath]
+            args[duration_idx] = str(float(args[duration_idx]) + duration_diff)
 
-            LOGGER.warning(str(e) +'; Retrying...')
+            LOGGER.warning('%s; Retrying...', e)
             continue
 
         except FfmpegValidationError as e:
             last_err = e
-            if attempt < num_retries - 1 and os.path.exists(output_path):
-                os.remove(output_path)
+            if attempt < num_retries - 1:
+                remove_outputs()
             # Retry if the output did not validate
-            LOGGER.info('ffmpeg output file "{}" did not validate: {}. Retrying...'.format(output_path, e))
+            LOGGER.info('ffmpeg output file "%s" did not validate: %s. Retrying...', output_path, e)
             continue
-    else:
-        error_msg = 'Maximum number of retries ({}) reached. Could not obtain inputs at {}. Error: {}'
-        LOGGER.error(error_msg.format(num_retries, input_path, str(last_err)))
+
+    error_msg = 'Maximum number of retries (%s) reached. Could not obtain inputs at %s. Error: %s'
+    LOGGER.error(error_msg, num_retries, input_path, last_err)
+    return False
+
+
+def get_youtube_dl():
+    """
+    Gets the YoutubeDL instance for the current thread, creating it on first use.
+
+    Reusing an instance keeps the extractors and the player signature cache
+    warm across videos. Instances are not shared between threads.
+
+    Returns:
+        ydl:  YoutubeDL instance
+              (Type: yt_dlp.YoutubeDL)
+    """
+    ydl = getattr(_THREAD_LOCAL, 'ydl', None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(YDL_OPTS)
+        _THREAD_LOCAL.ydl = ydl
+    return ydl
+
+
+def get_best_format(formats, video=True, audio=True):
+    """
+    Gets the best quality format that can be read directly by ffmpeg and that
+    does or does not contain video and audio streams.
+
+    Args:
+        formats:  List of formats as given by yt-dlp, sorted from worst to
+                  best quality
+                  (Type: list[dict[str, *]])
+
+    Keyword Args:
+        video:    If True, the format must contain a video stream. Otherwise,
+                  it must not contain one.
+                  (Type: bool)
+
+        audio:    If True, the format must contain an audio stream. Otherwise,
+                  it must not contain one.
+                  (Type: bool)
+
+    Returns:
+        best_format:  Best matching format, or None if there is none
+                      (Type: dict[str, *] or None)
+    """
+    for fmt in reversed(formats):
+        if fmt.get('protocol') not in ('http', 'https'):
+            continue
+        has_video = fmt.get('vcodec', 'none') != 'none'
+        has_audio = fmt.get('acodec', 'none') != 'none'
+        if has_video == video and has_audio == audio:
+            return fmt
+
+    return None
+
+
+def get_yt_video_info(ytid, cache_dir=None):
+    """
+    Resolve the duration and the directly downloadable streams of a YouTube video.
+
+    Only the fields used for stream selection are kept, so the result is small
+    enough to hold on to while the segments of the video are downloaded, and to
+    cache on disk. Cached info is used for up to `YT_URL_TTL` seconds, after
+    which the stream URLs may have expired.
+
+    The info of recently resolved videos is also kept in memory, so that
+    segments of the same video that are not adjacent in the subset file (or
+    that appear in several subsets) do not resolve it again.
+
+    Args:
+        ytid:       YouTube ID string
+                    (Type: str)
+
+    Keyword Args:
+        cache_dir:  Directory where video info is cached. If None, the
+                    video info is always resolved.
+                    (Type: str or None)
+
+    Returns:
+        yt_info:  Video info, containing the video 'duration' (in seconds),
+                  the available 'formats' (sorted from worst to best quality)
+                  and the time at which it was resolved ('resolved_at')
+                  (Type: dict[str, *])
+    """
+    # Entries are keyed by the current TTL period, and only hold info resolved
+    # during that period, so that they are never used for longer than YT_URL_TTL
+    return _resolve_yt_video_info(ytid, cache_dir, int(time.time() // YT_URL_TTL))
+
+
+@lru_cache(maxsize=YT_INFO_CACHE_SIZE)
+def _resolve_yt_video_info(ytid, cache_dir, ttl_period):
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, ytid + '.json')
+        try:
+            with open(cache_path, 'r') as f:
+                yt_info = json.load(f)
+            # Info resolved in an earlier period would outlive its stream URLs
+            # once it is kept in memory for the rest of this period
+            if yt_info['resolved_at'] >= ttl_period * YT_URL_TTL:
+                return yt_info
+        except (OSError, ValueError, KeyError):
+            pass
+
+    video_page_url = f'https://www.youtube.com/watch?v={ytid}'
+    info = get_youtube_dl().extract_info(video_page_url, download=False)
+    formats = [{k: fmt.get(k) for k in ('url', 'protocol', 'vcodec', 'acodec')}
+               for fmt in info.get('formats') or []]
+
+    yt_info = {
+        'duration': info['duration'],
+        'formats': formats,
+        'resolved_at': time.time()
+    }
+
+    if cache_dir:
+        # Write to a temporary file first so that readers never see a partial file
+        with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp',
+                                         delete=False) as f:
+            json.dump(yt_info, f)
+        os.replace(f.name, cache_path)
+
+    return yt_info
+
+
+def is_video_unavailable(error):
+    """
+    Checks whether a video could not be resolved because it is unavailable,
+    e.g. removed, private or blocked, rather than because of a transient issue
+    such as throttling or a dropped connection
+
+    Args:
+        error:  Error raised by yt-dlp
+                (Type: yt_dlp.utils.DownloadError)
+
+    Returns:
+        unavailable:  True if the video is unavailable
+                      (Type: bool)
+    """
+    # yt-dlp wraps the original exception. Network errors are marked as
+    # expected too, but are then the original exception themselves.
+    cause = error.exc_info[1] if error.exc_info else None
+    return isinstance(cause, yt_dlp.utils.ExtractorError) and cause.expected
 
 
 def download_yt_video(ytid, ts_start, ts_end, output_dir, ffmpeg_path, ffprobe_path,
@@ -305,7 +566,7 @@ def download_yt_video(ytid, ts_start, ts_end, output_dir, ffmpeg_path, ffprobe_p
                       audio_sample_rate=48000, audio_bit_depth=16,
                       video_codec='h264', video_format='mp4',
                       video_mode='bestvideoaudio', video_frame_rate=30,
-                      num_retries=10):
+                      num_retries=10, yt_info=None, scratch_dir=None):
     """
     Download a Youtube video (with the audio and video separated).
 
@@ -315,6 +576,9 @@ def download_yt_video(ytid, ts_start, ts_end, output_dir, ffmpeg_path, ffprobe_p
     The output filename is of the format:
         <YouTube ID>_<start time in ms>_<end time in ms>.<extension>
 
+    A SegmentDownloadError is raised if the audio or the video could not be
+    produced.
+
     Args:
         ytid:          Youtube ID string
                        (Type: str)
@@ -370,6 +634,14 @@ def download_yt_video(ytid, ts_start, ts_end, output_dir, ffmpeg_path, ffprobe_p
                             or video file with ffmpeg
                             (Type: int)
 
+        yt_info:            Video info previously obtained with
+                            get_yt_video_info(). If None, it is resolved here.
+                            (Type: dict[str, *] or None)
+
+        scratch_dir:        Directory where ffmpeg writes its outputs before
+                            they are moved into output_dir. If None, outputs
+                            are written to output_dir directly.
+                            (Type: str or None)
 
     Returns:
         video_filepath:  Filepath to video file
@@ -384,35 +656,62 @@ def download_yt_video(ytid, ts_start, ts_end, output_dir, ffmpeg_path, ffprobe_p
     # Make the output format and video URL
     # Output format is in the format:
     #   <YouTube ID>_<start time in ms>_<end time in ms>.<extension>
-    media_filename = get_media_filename(ytid, ts_start, ts_end)
-    video_filepath = os.path.join(output_dir, 'video', media_filename + '.' + video_format)
-    audio_filepath = os.path.join(output_dir, 'audio', media_filename + '.' + audio_format)
-    video_page_url = 'https://www.youtube.com/watch?v={}'.format(ytid)
+    video_filepath, audio_filepath = get_media_filepaths(output_dir, ytid, ts_start, ts_end,
+                                                         video_format, audio_format)
+    final_video_filepath, final_audio_filepath = video_filepath, audio_filepath
+    if scratch_dir:
+        # Have ffmpeg write to the scratch directory, and only move the
+        # outputs into place once they have been produced successfully
+        video_filepath, audio_filepath = get_media_filepaths(
+            os.path.join(scratch_dir, os.path.basename(output_dir)),
+            ytid, ts_start, ts_end, video_format, audio_format)
+        # Files left behind by an interrupted run would be mistaken for
+        # finished outputs by ffmpeg
+        for path in (video_filepath, audio_filepath):
+            if os.path.exists(path):
+                os.remove(path)
+    # Outputs that are already in the data directory are not produced again,
+    # rather than being overwritten from the scratch directory. As in
+    # get_downloaded_media_filenames(), empty files left by an interrupted run
+    # do not count, and are removed so that ffmpeg can replace them.
+    existing_filepaths = []
+    for path, final_path in ((video_filepath, final_video_filepath),
+                             (audio_filepath, final_audio_filepath)):
+        try:
+            file_size = os.stat(final_path).st_size
+        except FileNotFoundError:
+            continue
+        if file_size > 0:
+            existing_filepaths.append(path)
+        else:
+            os.remove(final_path)
+    completed_filepaths = []
 
     # Get the direct URLs to the videos with best audio and with best video (with audio)
-
-    video = pafy.new(video_page_url)
-    video_duration = video.length
+    if yt_info is None:
+        yt_info = get_yt_video_info(ytid)
+    formats = yt_info['formats']
+    video_duration = yt_info['duration']
     end_past_video_end = False
     if ts_end > video_duration:
-        warn_msg = "End time for segment ({} - {}) of video {} extends past end of video (length {} sec)"
-        LOGGER.warning(warn_msg.format(ts_start, ts_end, ytid, video_duration))
+        warn_msg = "End time for segment (%s - %s) of video %s extends past end of video (length %s sec)"
+        LOGGER.warning(warn_msg, ts_start, ts_end, ytid, video_duration)
         duration = video_duration - ts_start
         ts_end = ts_start + duration
         end_past_video_end = True
 
     if video_mode in ('bestvideo', 'bestvideowithaudio'):
-        best_video = video.getbestvideo()
+        best_video = get_best_format(formats, video=True, audio=False)
         # If there isn't a video only option, go with best video with audio
         if best_video is None:
-            best_video = video.getbest()
+            best_video = get_best_format(formats, video=True, audio=True)
     elif video_mode in ('bestvideoaudio', 'bestvideoaudionoaudio'):
-        best_video = video.getbest()
+        best_video = get_best_format(formats, video=True, audio=True)
     else:
         raise ValueError('Invalid video mode: {}'.format(video_mode))
-    best_audio = video.getbestaudio()
-    best_video_url = best_video.url
-    best_audio_url = best_audio.url
+    if best_video is None:
+        raise ValueError('Could not find a suitable video stream for video {}'.format(ytid))
+    best_video_url = best_video['url']
 
     audio_info = {
         'sample_rate': audio_sample_rate,
@@ -427,105 +726,235 @@ def download_yt_video(ytid, ts_start, ts_end, output_dir, ffmpeg_path, ffprobe_p
         'codec_name': video_codec.lower(),
         'duration': duration
     }
-    # Download the audio
-    audio_input_args = ['-n', '-ss', str(ts_start)]
-    audio_output_args = ['-t', str(duration),
-                         '-ar', str(audio_sample_rate),
+    audio_output_args = ['-ar', str(audio_sample_rate),
                          '-vn',
                          '-ac', str(audio_info['channels']),
                          '-sample_fmt', 's{}'.format(audio_bit_depth),
                          '-f', audio_format,
                          '-acodec', audio_codec]
-    ffmpeg(ffmpeg_path, best_audio_url, audio_filepath,
-           input_args=audio_input_args, output_args=audio_output_args,
-           num_retries=num_retries, validation_callback=validate_audio,
-           validation_args={'audio_info': audio_info,
-                            'end_past_video_end': end_past_video_end})
-
-    if video_mode != 'bestvideowithaudio':
-        # Download the video
-        video_input_args = ['-n', '-ss', str(ts_start)]
-        video_output_args = ['-t', str(duration),
+    audio_validation_args = {'audio_info': audio_info,
+                             'end_past_video_end': end_past_video_end}
+    video_validation_args = {'ffprobe_path': ffprobe_path,
+                             'video_info': video_info,
+                             'end_past_video_end': end_past_video_end}
+
+    if video_mode in ('bestvideoaudio', 'bestvideoaudionoaudio'):
+        # The best video already contains an audio stream, so extract the audio
+        # and the video with a single ffmpeg invocation. The duration is given
+        # as an input option so that it applies to both outputs.
+        input_args = HTTP_INPUT_ARGS + ['-n', '-ss', str(ts_start), '-t', str(duration)]
+        video_output_args = ['-map', '0:v:0',
                              '-f', video_format,
                              '-r', str(video_frame_rate),
                              '-vcodec', video_codec]
         # Suppress audio stream if we don't want to audio in the video
-        if video_mode in ('bestvideo', 'bestvideoaudionoaudio'):
+        if video_mode == 'bestvideoaudio':
+            video_output_args += ['-map', '0:a:0']
+        else:
             video_output_args.append('-an')
 
-        ffmpeg(ffmpeg_path, best_video_url, video_filepath,
-               input_args=video_input_args, output_args=video_output_args,
-               num_retries=num_retries, validation_callback=validate_video,
-               validation_args={'ffprobe_path': ffprobe_path,
-                                'video_info': video_info,
-                                'end_past_video_end': end_past_video_end})
+        outputs = [(audio_filepath, ['-map', '0:a:0'] + audio_output_args,
+                    validate_audio, audio_validation_args),
+                   (video_filepath, video_output_args,
+                    validate_video, video_validation_args)]
+        # ffmpeg aborts the whole command if any output exists, so only
+        # produce the outputs that are still missing
+        outputs = [output for output in outputs if output[0] not in existing_filepaths]
+        if outputs:
+            output_paths, output_args, callbacks, callback_args = map(list, zip(*outputs))
+            if ffmpeg(ffmpeg_path, best_video_url, output_paths,
+                      input_args=input_args, output_args=output_args,
+                      num_retries=num_retries, validation_callback=callbacks,
+                      validation_args=callback_args):
+                completed_filepaths += output_paths
     else:
-        # Download the best quality video, in lossless encoding
-        if video_codec != 'h264':
-            error_msg = 'Not currently supporting merging of best quality video with video for codec: {}'
-            raise NotImplementedError(error_msg.format(video_codec))
-        video_input_args = ['-n', '-ss', str(ts_start)]
-        video_output_args = ['-t', str(duration),
-                             '-f', video_format,
-                             '-crf', '0',
-                             '-preset', 'medium',
-                             '-r', str(video_frame_rate),
-                             '-an',
-                             '-vcodec', video_codec]
+        # Download the audio from the best audio-only stream
+        best_audio = get_best_format(formats, video=False, audio=True)
+        if best_audio is None:
+            raise ValueError('Could not find a suitable audio stream for video {}'.format(ytid))
+        best_audio_url = best_audio['url']
+        audio_input_args = HTTP_INPUT_ARGS + ['-n', '-ss', str(ts_start)]
+        audio_output_args = ['-t', str(duration)] + audio_output_args
+        if audio_filepath not in existing_filepaths:
+            if ffmpeg(ffmpeg_path, best_audio_url, audio_filepath,
+                      input_args=audio_input_args, output_args=audio_output_args,
+                      num_retries=num_retries, validation_callback=validate_audio,
+                      validation_args=audio_validation_args):
+                completed_filepaths.append(audio_filepath)
+
+        if video_filepath in existing_filepaths:
+            # The video was already downloaded
+            pass
+        elif video_mode == 'bestvideo':
+            # Download the video
+            video_input_args = HTTP_INPUT_ARGS + ['-n', '-ss', str(ts_start)]
+            video_output_args = ['-t', str(duration),
+                                 '-f', video_format,
+                                 '-r', str(video_frame_rate),
+                                 '-vcodec', video_codec,
+                                 '-an']
+
+            if ffmpeg(ffmpeg_path, best_video_url, video_filepath,
+                      input_args=video_input_args, output_args=video_output_args,
+                      num_retries=num_retries, validation_callback=validate_video,
+                      validation_args=video_validation_args):
+                completed_filepaths.append(video_filepath)
+        else:
+            # Download the best quality video. It is encoded to its final
+            # codec here, so that merging only has to copy the video stream.
+            if video_codec != 'h264':
+                error_msg = 'Not currently supporting merging of best quality video with video for codec: {}'
+                raise NotImplementedError(error_msg.format(video_codec))
+            video_input_args = HTTP_INPUT_ARGS + ['-n', '-ss', str(ts_start)]
+            video_output_args = ['-t', str(duration),
+                                 '-f', video_format,
+                                 '-r', str(video_frame_rate),
+                                 '-an',
+                                 '-vcodec', video_codec]
+
+            ffmpeg(ffmpeg_path, best_video_url, video_filepath,
+                   input_args=video_input_args, output_args=video_output_args,
+                   num_retries=num_retries)
+
+            # Merge the video with the lossless audio, compressing the audio
+            merge_video_filepath = os.path.splitext(video_filepath)[0] \
+                                   + '_merge.' + video_format
+            video_input_args = ['-n']
+            video_output_args = ['-f', video_format,
+                                 '-vcodec', 'copy',
+                                 '-acodec', 'aac',
+                                 '-ar', str(audio_sample_rate),
+                                 '-ac', str(audio_info['channels']),
+                                 '-strict', 'experimental']
+
+            # The audio may only be in the data directory if it already existed
+            if audio_filepath in existing_filepaths:
+                merge_audio_filepath = final_audio_filepath
+            else:
+                merge_audio_filepath = audio_filepath
+            merged = ffmpeg(ffmpeg_path, [video_filepath, merge_audio_filepath],
+                            merge_video_filepath, input_args=video_input_args,
+                            output_args=video_output_args, num_retries=num_retries,
+                            validation_callback=validate_video,
+                            validation_args=video_validation_args)
+
+            # Remove the original video file and replace with the merged version
+            if merged and os.path.exists(merge_video_filepath):
+                os.remove(video_filepath)
+                shutil.move(merge_video_filepath, video_filepath)
+                completed_filepaths.append(video_filepath)
+            else:
+                # ffmpeg keeps the output of its last failed attempt
+                if os.path.exists(merge_video_filepath):
+                    os.remove(merge_video_filepath)
+                error_msg = 'Could not merge video for %s (%s - %s) into %s'
+                LOGGER.error(error_msg, ytid, ts_start, ts_end, merge_video_filepath)
+
+    # ffmpeg gives up on an output after running out of retries (e.g. on
+    # repeated HTTP errors), in which case it is missing
+    missing_filepaths = [final_path for path, final_path
+                         in ((video_filepath, final_video_filepath),
+                             (audio_filepath, final_audio_filepath))
+                         if path not in completed_filepaths
+                         and path not in existing_filepaths]
+
+    if scratch_dir:
+        for path, final_path in ((video_filepath, final_video_filepath),
+                                 (audio_filepath, final_audio_filepath)):
+            if path in completed_filepaths:
+                move_file(path, final_path)
+            elif os.path.exists(path):
+                os.remove(path)
+        video_filepath, audio_filepath = final_video_filepath, final_audio_filepath
+
+    if missing_filepaths:
+        raise SegmentDownloadError(ytid, ts_start, ts_end, missing_filepaths)
+
+    LOGGER.debug('Downloaded video %s (%s - %s)', ytid, ts_start, ts_end)
 
-        ffmpeg(ffmpeg_path, best_video_url, video_filepath,
-               input_args=video_input_args, output_args=video_output_args,
-               num_retries=num_retries)
+    return video_filepath, audio_filepath
 
-        # Merge the best lossless video with the lossless audio, and compress
-        merge_video_filepath = os.path.splitext(video_filepath)[0] \
-                               + '_merge.' + video_format
-        video_input_args = ['-n']
-        video_output_args = ['-f', video_format,
-                             '-r', str(video_frame_rate),
-                             '-vcodec', video_codec,
-                             '-acodec', 'aac',
-                             '-ar', str(audio_sample_rate),
-                             '-ac', str(audio_info['channels']),
-                             '-strict', 'experimental']
-
-        ffmpeg(ffmpeg_path, [video_filepath, audio_filepath], merge_video_filepath,
-               input_args=video_input_args, output_args=video_output_args,
-               num_retries=num_retries, validation_callback=validate_video,
-               validation_args={'ffprobe_path': ffprobe_path,
-                                'video_info': video_info,
-                                'end_past_video_end': end_past_video_end})
-
-        # Remove the original video file and replace with the merged version
-        if os.path.exists(merge_video_filepath):
-            os.remove(video_filepath)
-            shutil.move(merge_video_filepath, video_filepath)
-        else:
-            error_msg = 'Cannot find merged video for {} ({} - {}) at {}'
-            LOGGER.error(error_msg.format(ytid, ts_start, ts_end, merge_video_filepath))
 
-    LOGGER.info('Downloaded video {} ({} - {})'.format(ytid, ts_start, ts_end))
+def get_downloaded_media_filenames(data_dir, video_format='mp4', audio_format='flac'):
+    """
+    Gets the media filenames (without extension) of the segments for which both
+    an audio and a video file exist.
 
-    return video_filepath, audio_filepath
+    Each media directory is listed once with os.scandir, instead of checking
+    every segment with os.path.exists. Only non-empty files with the expected
+    extension are counted, so that files of other formats, temporary files or
+    empty files left by an interrupted run do not mark a segment as downloaded.
+
+    Args:
+        data_dir:      Subset data directory
+                       (Type: str)
+
+    Keyword Args:
+        video_format:  Video file extension
+                       (Type: str)
+
+        audio_format:  Audio file extension
+                       (Type: str)
+
+    Returns:
+        media_filenames:  Media filenames of downloaded segments
+                          (Type: frozenset[str])
+    """
+    video_ext, audio_ext = f'.{video_format}', f'.{audio_format}'
+    video_names = {entry.name[:-len(video_ext)]
+                   for entry in os.scandir(os.path.join(data_dir, 'video'))
+                   if entry.name.endswith(video_ext) and entry.stat().st_size > 0}
+    audio_names = {entry.name[:-len(audio_ext)]
+                   for entry in os.scandir(os.path.join(data_dir, 'audio'))
+                   if entry.name.endswith(audio_ext) and entry.stat().st_size > 0}
+    return frozenset(video_names & audio_names)
+
+
+def is_segment_downloaded(downloaded, ytid, ts_start, ts_end):
+    """
+    Checks whether both the audio and video files of a segment already exist
+
+    Args:
+        downloaded:  Media filenames of downloaded segments, as given by
+                     get_downloaded_media_filenames()
+                     (Type: frozenset[str])
+
+        ytid:        Youtube ID string
+                     (Type: str)
 
+        ts_start:    Segment start time (in seconds)
+                     (Type: float)
 
-def segment_mp_worker(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
-                      ffprobe_path, **ffmpeg_cfg):
+        ts_end:      Segment end time (in seconds)
+                     (Type: float)
+
+    Returns:
+        is_downloaded:  True if the segment has already been downloaded
+                        (Type: bool)
+    """
+    if get_media_filename(ytid, ts_start, ts_end) in downloaded:
+        LOGGER.debug('Already downloaded video %s (%s - %s). Skipping.', ytid, ts_start, ts_end)
+        return True
+
+    return False
+
+
+def segment_mp_worker(ytid, segments, data_dir, ffmpeg_path,
+                      ffprobe_path, metadata_cache_dir=None, **ffmpeg_cfg):
     """
-    Pool worker that downloads video segments.o
+    Thread pool worker that downloads the segments of a single video.
 
     Wraps around the download_yt_video function to catch errors and log them.
+    The video's stream URLs are resolved once and shared by all of its
+    segments, and are only resolved again if they may have expired.
 
     Args:
 
         ytid:          Youtube ID string
                        (Type: str)
 
-        ts_start:      Segment start time (in seconds)
-                       (Type: float)
-
-        ts_end:        Segment end time (in seconds)
-                       (Type: float)
+        segments:      Segment start and end times (in seconds)
+                       (Type: list[tuple[float, float]])
 
         data_dir:      Directory where videos will be saved
                        (Type: str)
@@ -537,25 +966,74 @@ def segment_mp_worker(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
                        (Type: str)
 
     Keyword Args:
-        **ffmpeg_cfg:  Configuration for audio and video
-                       downloading and decoding done by ffmpeg
-                       (Type: dict[str, *])
+        metadata_cache_dir:  Directory where resolved video info is cached
+                             (Type: str or None)
+
+        **ffmpeg_cfg:        Configuration for audio and video
+                             downloading and decoding done by ffmpeg
+                             (Type: dict[str, *])
     """
-    LOGGER.info('Attempting to download video {} ({} - {})'.format(ytid, ts_start, ts_end))
+    yt_info = None
+    for segment_idx, (ts_start, ts_end) in enumerate(segments):
+        LOGGER.debug('Attempting to download video %s (%s - %s)', ytid, ts_start, ts_end)
 
-    # Download the video
-    try:
-        download_yt_video(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
-                          ffprobe_path, **ffmpeg_cfg)
-    except SubprocessError as e:
-        err_msg = 'Error while downloading video {}: {}; {}'.format(ytid, e, tb.format_exc())
-        LOGGER.error(err_msg)
-    except Exception as e:
-        err_msg = 'Error while processing video {}: {}; {}'.format(ytid, e, tb.format_exc())
-        LOGGER.error(err_msg)
+        # Download the video
+        failed = True
+        try:
+            if yt_info is None or time.time() - yt_info['resolved_at'] > YT_URL_TTL:
+                yt_info = get_yt_video_info(ytid, cache_dir=metadata_cache_dir)
+            download_yt_video(ytid, ts_start, ts_end, data_dir, ffmpeg_path,
+                              ffprobe_path, yt_info=yt_info, **ffmpeg_cfg)
+            failed = False
+        except yt_dlp.utils.DownloadError as e:
+            LOGGER.error('Could not resolve video %s: %s', ytid, e)
+            if is_video_unavailable(e):
+                # The remaining segments of an unavailable video would fail
+                # in the same way
+                num_failed = len(segments) - segment_idx
+                with _PROGRESS_LOCK:
+                    _PROGRESS['processed'] += num_failed
+                    _PROGRESS['failed'] += num_failed
+                return
+        except SegmentDownloadError as e:
+            # ffmpeg has already logged why the outputs could not be produced
+            LOGGER.error(str(e))
+        except Exception as e:
+            action = 'downloading' if isinstance(e, SubprocessError) else 'processing'
+            LOGGER.error('Error while %s video %s: %s; %s', action, ytid, e, tb.format_exc())
+
+        with _PROGRESS_LOCK:
+            _PROGRESS['processed'] += 1
+            if failed:
+                _PROGRESS['failed'] += 1
+
+
+def report_progress(stop_event, interval=PROGRESS_INTERVAL):
+    """
+    Periodically logs the number of processed segments, in place of logging
+    every segment.
 
+    Args:
+        stop_event:  Event that is set to stop reporting
+                     (Type: threading.Event)
 
-def init_subset_data_dir(dataset_dir, subset_name):
+    Keyword Args:
+        interval:    Number of seconds between reports
+                     (Type: float)
+    """
+    last_processed = 0
+    last_time = time.monotonic()
+    while not stop_event.wait(interval):
+        with _PROGRESS_LOCK:
+            processed = _PROGRESS['processed']
+            failed = _PROGRESS['failed']
+        now = time.monotonic()
+        rate = (processed - last_processed) / (now - last_time)
+        LOGGER.info('Processed %d segments (%d failed), %.1f segments/s', processed, failed, rate)
+        last_processed, last_time = processed, now
+
+
+def init_subset_data_dir(dataset_dir, subset_name, scratch_dir=None):
     """
     Creates the data directories for the given subset
 
@@ -566,6 +1044,11 @@ def init_subset_data_dir(dataset_dir, subset_name):
         subset_name:  Name of subset
                       (Type: str)
 
+    Keyword Args:
+        scratch_dir:  Scratch directory where outputs are staged. If given, the
+                      subset's audio and video directories are mirrored in it.
+                      (Type: str or None)
+
     Returns:
         data_dir:  Path to subset data dir
                    (Type: str)
@@ -577,6 +1060,10 @@ def init_subset_data_dir(dataset_dir, subset_name):
     os.makedirs(audio_dir, exist_ok=True)
     os.makedirs(video_dir, exist_ok=True)
 
+    if scratch_dir:
+        os.makedirs(os.path.join(scratch_dir, subset_name, 'audio'), exist_ok=True)
+        os.makedirs(os.path.join(scratch_dir, subset_name, 'video'), exist_ok=True)
+
     return data_dir
 
 
@@ -603,18 +1090,56 @@ def download_subset_file(subset_url, dataset_dir):
 
     os.makedirs(dataset_dir, exist_ok=True)
 
-    # Open subset file as a CSV
+    # Stream the subset file to disk so that it is never buffered in memory
     if not os.path.exists(subset_path):
-        LOGGER.info('Downloading subset file for "{}"'.format(subset_name))
-        with open(subset_path, 'w') as f:
-            subset_data = urllib.request.urlopen(subset_url).read().decode()
-            f.write(subset_data)
+        LOGGER.info('Downloading subset file for "%s"', subset_name)
+        resp = HTTP.request('GET', subset_url, preload_content=False)
+        try:
+            if resp.status != 200:
+                error_msg = 'Could not download subset file from {} (HTTP status {})'
+                raise urllib3.exceptions.HTTPError(error_msg.format(subset_url, resp.status))
+            # Write to a temporary file first, so that an interrupted download
+            # is never mistaken for a complete subset file
+            f = tempfile.NamedTemporaryFile('wb', dir=dataset_dir, suffix='.tmp',
+                                            delete=False)
+            try:
+                with f:
+                    shutil.copyfileobj(resp, f, length=COPY_BUFFER_SIZE)
+                os.replace(f.name, subset_path)
+            except BaseException:
+                os.remove(f.name)
+                raise
+        finally:
+            resp.release_conn()
 
     return subset_path
 
 
+class BoundedThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Thread pool whose submit() blocks while the pool already holds
+    max_pending jobs that have not finished.
+
+    The subset files are read lazily, so this keeps the reader only a little
+    ahead of the workers instead of queueing every segment of a subset.
+    """
+    def __init__(self, max_workers, max_pending, **kwargs):
+        super().__init__(max_workers=max_workers, **kwargs)
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args, **kwargs):
+        self._pending.acquire()
+        try:
+            future = super().submit(fn, *args, **kwargs)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+
+
 def download_subset_videos(subset_path, data_dir, ffmpeg_path, ffprobe_path,
-                           num_workers, **ffmpeg_cfg):
+                           executor, **ffmpeg_cfg):
     """
     Download subset segment file and videos
 
@@ -631,8 +1156,9 @@ def download_subset_videos(subset_path, data_dir, ffmpeg_path, ffprobe_path,
         ffprobe_path:  Path to ffprobe executable
                        (Type: str)
 
-        num_workers:   Number of multiprocessing workers used to download videos
-                       (Type: int)
+        executor:      Executor that the download jobs are submitted to. The
+                       caller is responsible for shutting it down.
+                       (Type: concurrent.futures.Executor)
 
     Keyword Args:
         **ffmpeg_cfg:  Configuration for audio and video
@@ -640,50 +1166,37 @@ def download_subset_videos(subset_path, data_dir, ffmpeg_path, ffprobe_path,
                        (Type: dict[str, *])
     """
     subset_name = get_subset_name(subset_path)
+    downloaded = get_downloaded_media_filenames(data_dir,
+                                                video_format=ffmpeg_cfg.get('video_format', 'mp4'),
+                                                audio_format=ffmpeg_cfg.get('audio_format', 'flac'))
 
-    LOGGER.info('Starting download jobs for subset "{}"'.format(subset_name))
-    with open(subset_path, 'r') as f:
-        subset_data = csv.reader(f)
+    LOGGER.info('Starting download jobs for subset "%s"', subset_name)
 
-        # Set up multiprocessing pool
-        pool = mp.Pool(num_workers)
-        try:
-            for row_idx, row in enumerate(subset_data):
-                # Skip commented lines
-                if row[0][0] == '#':
-                    continue
-                ytid, ts_start, ts_end = row[0], float(row[1]), float(row[2])
-
-                # Skip files that already have been downloaded
-                media_filename = get_media_filename(ytid, ts_start, ts_end)
-                video_filepath = os.path.join(data_dir, 'video', media_filename + '.' + ffmpeg_cfg.get('video_format', 'mp4'))
-                audio_filepath = os.path.join(data_dir, 'audio', media_filename + '.' + ffmpeg_cfg.get('audio_format', 'flac'))
-                if os.path.exists(video_filepath) and os.path.exists(audio_filepath):
-                    info_msg = 'Already downloaded video {} ({} - {}). Skipping.'
-                    LOGGER.info(info_msg.format(ytid, ts_start, ts_end))
-                    continue
-
-                worker_args = [ytid, ts_start, ts_end, data_dir, ffmpeg_path, ffprobe_path]
-                pool.apply_async(partial(segment_mp_worker, **ffmpeg_cfg), worker_args)
-                # Run serially
-                #segment_mp_worker(*worker_args, **ffmpeg_cfg)
-
-        except csv.Error as e:
-            err_msg = 'Encountered error in {} at line {}: {}'
-            LOGGER.error(err_msg)
-            sys.exit(err_msg.format(subset_path, row_idx+1, e))
-        except KeyboardInterrupt:
-            LOGGER.info("Forcing exit.")
-            exit()
-        finally:
-            try:
-                pool.close()
-                pool.join()
-            except KeyboardInterrupt:
-                LOGGER.info("Forcing exit.")
-                exit()
+    # Bind the arguments shared by all videos once, rather than per submission
+    worker = partial(segment_mp_worker, data_dir=data_dir, ffmpeg_path=ffmpeg_path,
+                     ffprobe_path=ffprobe_path, **ffmpeg_cfg)
 
-    LOGGER.info('Finished download jobs for subset "{}"'.format(subset_name))
+    try:
+        # Consecutive segments of the same video are handled by one worker so
+        # that the video's stream URLs are only resolved once
+        for ytid, video_segments in itertools.groupby(iter_subset_segments(subset_path),
+                                                      key=operator.itemgetter(0)):
+            segments = [(ts_start, ts_end) for _, ts_start, ts_end in video_segments
+                        if not is_segment_downloaded(downloaded, ytid, ts_start, ts_end)]
+
+            if not segments:
+                continue
+
+            executor.submit(worker, ytid, segments)
+            # Run serially
+            #worker(ytid, segments)
+
+    except SubsetFileError as e:
+        LOGGER.error(str(e))
+        executor.shutdown(wait=False, cancel_futures=True)
+        sys.exit(str(e))
+
+    LOGGER.info('Submitted download jobs for subset "%s"', subset_name)
 
 
 def download_random_subset_files(subset_url, dataset_dir, ffmpeg_path, ffprobe_path,
@@ -704,7 +1217,7 @@ def download_random_subset_files(subset_url, dataset_dir, ffmpeg_path, ffprobe_p
         ffprobe_path:  Path to ffprobe executable
                        (Type: str)
 
-        num_workers:   Number of multiprocessing workers used to download videos
+        num_workers:   Number of worker threads used to download videos
                        (Type: int)
 
     Keyword Args:
@@ -723,68 +1236,77 @@ def download_random_subset_files(subset_url, dataset_dir, ffmpeg_path, ffprobe_p
         LOGGER.error(err_msg)
         raise ValueError(err_msg)
 
-    # Get filename of the subset file
-    subset_filename = get_filename(subset_url)
+    # Get the subset file
     subset_name = get_subset_name(subset_url)
-    subset_path = os.path.join(dataset_dir, subset_filename)
-    data_dir = init_subset_data_dir(dataset_dir, subset_name)
+    subset_path = download_subset_file(subset_url, dataset_dir)
+    data_dir = init_subset_data_dir(dataset_dir, subset_name,
+                                    scratch_dir=ffmpeg_cfg.get('scratch_dir'))
 
-    # Open subset file as a CSV
-    if not os.path.exists(subset_path):
-        LOGGER.info('Downloading subset file for "{}"'.format(subset_name))
-        with open(subset_path, 'w') as f:
-            subset_data = urllib.request.urlopen(subset_url).read().decode()
-            f.write(subset_data)
-
-    subset_data = []
-    LOGGER.info('Starting download jobs for random subset (of size {}) of subset "{}"'.format(max_videos, subset_name))
-    with open(subset_path, 'r') as f:
-        subset_data_reader = csv.reader(f)
-        try:
-            for row_idx, row in enumerate(subset_data_reader):
-                # Skip commented lines
-                if row[0][0] == '#':
-                    continue
-
-                subset_data.append(row[:3])
-        except csv.Error as e:
-            err_msg = 'Encountered error in {} at line {}: {}'
-            LOGGER.error(err_msg)
-            sys.exit(err_msg.format(subset_filename, row_idx+1, e))
+    LOGGER.info('Starting download jobs for random subset (of size %s) of subset "%s"', max_videos, subset_name)
+    try:
+        if max_videos is None:
+            subset_data = list(iter_subset_segments(subset_path))
+        else:
+            # Reservoir sample so that only max_videos segments are held in
+            # memory, rather than the whole (possibly ~2M line) subset file
+            subset_data = []
+            for idx, segment in enumerate(iter_subset_segments(subset_path)):
+                if idx < max_videos:
+                    subset_data.append(segment)
+                else:
+                    sample_idx = random.randint(0, idx)
+                    if sample_idx < max_videos:
+                        subset_data[sample_idx] = segment
+    except SubsetFileError as e:
+        LOGGER.error(str(e))
+        sys.exit(str(e))
 
     # Shuffle data
     random.shuffle(subset_data)
 
-    # Set up multiprocessing pool
-    pool = mp.Pool(num_workers)
+    # Group the selected segments by video so that each video's stream URLs are
+    # only resolved once
+    downloaded = get_downloaded_media_filenames(data_dir,
+                                                video_format=ffmpeg_cfg.get('video_format', 'mp4'),
+                                                audio_format=ffmpeg_cfg.get('audio_format', 'flac'))
+    video_segments = {}
+    for ytid, ts_start, ts_end in subset_data:
+        if is_segment_downloaded(downloaded, ytid, ts_start, ts_end):
+            continue
+        video_segments.setdefault(ytid, []).append((ts_start, ts_end))
+
+    # Bind the arguments shared by all videos once, rather than per submission
+    worker = partial(segment_mp_worker, data_dir=data_dir, ffmpeg_path=ffmpeg_path,
+                     ffprobe_path=ffprobe_path, **ffmpeg_cfg)
+
+    # Set up thread pool
+    executor = BoundedThreadPoolExecutor(num_workers,
+                                         num_workers * (1 + MAX_PENDING_PER_WORKER))
     try:
-        for idx, row in enumerate(subset_data):
-            worker_args = [row[0], float(row[1]), float(row[2]), data_dir, ffmpeg_path, ffprobe_path]
-            pool.apply_async(partial(segment_mp_worker, **ffmpeg_cfg), worker_args)
+        for ytid, segments in video_segments.items():
+            executor.submit(worker, ytid, segments)
             # Run serially
-            #segment_mp_worker(*worker_args, **ffmpeg_cfg)
+            #worker(ytid, segments)
 
-            if max_videos is not None:
-                if idx + 1 >= max_videos:
-                    info_msg = 'Reached maximum ({}) for subset {}'
-                    LOGGER.info(info_msg.format(max_videos, subset_name))
-                    break
+        if max_videos is not None and len(subset_data) == max_videos:
+            LOGGER.info('Reached maximum (%s) for subset %s', max_videos, subset_name)
     except KeyboardInterrupt:
         LOGGER.info("Forcing exit.")
+        executor.shutdown(wait=False, cancel_futures=True)
         exit()
     finally:
         try:
-            pool.close()
-            pool.join()
+            executor.shutdown(wait=True)
         except KeyboardInterrupt:
             LOGGER.info("Forcing exit.")
+            executor.shutdown(wait=False, cancel_futures=True)
             exit()
 
-    LOGGER.info('Finished download jobs for subset "{}"'.format(subset_name))
+    LOGGER.info('Finished download jobs for subset "%s"', subset_name)
 
 
 def download_subset(subset_path, dataset_dir, ffmpeg_path, ffprobe_path,
-                    num_workers, **ffmpeg_cfg):
+                    executor, **ffmpeg_cfg):
     """
     Download all files for a subset, including the segment file, and the audio and video files.
 
@@ -801,8 +1323,8 @@ def download_subset(subset_path, dataset_dir, ffmpeg_path, ffprobe_path,
         ffprobe_path:   Path to ffprobe executable
                         (Type: str)
 
-        num_workers:    Number of workers to download and process videos
-                        (Type: int)
+        executor:       Executor that the download jobs are submitted to
+                        (Type: concurrent.futures.Executor)
 
     Keyword Args:
         **ffmpeg_cfg:                   Configuration for audio and video
@@ -816,16 +1338,17 @@ def download_subset(subset_path, dataset_dir, ffmpeg_path, ffprobe_path,
         subset_path = download_subset_file(subset_path, dataset_dir)
 
     subset_name = get_subset_name(subset_path)
-    data_dir = init_subset_data_dir(dataset_dir, subset_name)
+    data_dir = init_subset_data_dir(dataset_dir, subset_name,
+                                    scratch_dir=ffmpeg_cfg.get('scratch_dir'))
 
     download_subset_videos(subset_path, data_dir, ffmpeg_path, ffprobe_path,
-                           num_workers, **ffmpeg_cfg)
+                           executor, **ffmpeg_cfg)
 
 
 def download_audioset(data_dir, ffmpeg_path, ffprobe_path, eval_segments_path,
                       balanced_train_segments_path, unbalanced_train_segments_path,
                       disable_logging=False, verbose=False, num_workers=4,
-                      log_path=None, **ffmpeg_cfg):
+                      log_path=None, metadata_cache_dir=None, **ffmpeg_cfg):
     """
     Download AudioSet files
 
@@ -854,34 +1377,72 @@ def download_audioset(data_dir, ffmpeg_path, ffprobe_path, eval_segments_path,
                                         (Type: bool)
 
         verbose:                        Prints verbose information to stdout
-                                        if True
+                                        if True. Otherwise, debug records are
+                                        not logged at all, including to the
+                                        log file.
                                         (Type: bool)
 
-        num_workers:                    Number of multiprocessing workers used
-                                        to download videos
+        num_workers:                    Number of worker threads used to
+                                        download videos
                                         (Type: int)
 
         log_path:                       Path where log file will be saved. If
                                         None, saved to './audiosetdl.log'
                                         (Type: str or None)
 
+        metadata_cache_dir:             Directory where resolved YouTube
+                                        stream URLs are cached. If None, no
+                                        cache is used.
+                                        (Type: str or None)
+
         **ffmpeg_cfg:                   Configuration for audio and video
                                         downloading and decoding done by ffmpeg
                                         (Type: dict[str, *])
     """
+    # Per-segment debug records are only created when running verbosely
+    LOGGER.setLevel(logging.DEBUG if verbose else logging.INFO)
     init_console_logger(LOGGER, verbose=verbose)
     if not disable_logging:
         init_file_logger(LOGGER, log_path=log_path)
-    multiprocessing_logging.install_mp_handler()
+    log_listener = init_queue_logger(LOGGER)
     LOGGER.debug('Initialized logging.')
 
-
-    download_subset(eval_segments_path, data_dir, ffmpeg_path, ffprobe_path,
-                    num_workers, **ffmpeg_cfg)
-    download_subset(balanced_train_segments_path, data_dir, ffmpeg_path, ffprobe_path,
-                    num_workers, **ffmpeg_cfg)
-    download_subset(unbalanced_train_segments_path, data_dir, ffmpeg_path, ffprobe_path,
-                    num_workers, **ffmpeg_cfg)
+    # Resolve the executables once, rather than on every subprocess spawn
+    ffmpeg_path = os.path.abspath(shutil.which(ffmpeg_path) or ffmpeg_path)
+    ffprobe_path = os.path.abspath(shutil.which(ffprobe_path) or ffprobe_path)
+
+    if metadata_cache_dir:
+        os.makedirs(metadata_cache_dir, exist_ok=True)
+
+    # Set up a thread pool shared by all subsets, so that workers move on to
+    # the next subset as soon as they are free instead of waiting for the
+    # slowest video of the previous one. Workers spend nearly all of their
+    # time waiting on the network and on ffmpeg subprocesses, so threads are
+    # sufficient.
+    executor = BoundedThreadPoolExecutor(num_workers,
+                                         num_workers * (1 + MAX_PENDING_PER_WORKER))
+    stop_reporting = threading.Event()
+    reporter = threading.Thread(target=report_progress, args=(stop_reporting,),
+                                daemon=True)
+    reporter.start()
+    try:
+        for subset_path in (eval_segments_path, balanced_train_segments_path,
+                            unbalanced_train_segments_path):
+            download_subset(subset_path, data_dir, ffmpeg_path, ffprobe_path,
+                            executor, metadata_cache_dir=metadata_cache_dir,
+                            **ffmpeg_cfg)
+        executor.shutdown(wait=True)
+        LOGGER.info('Finished download jobs')
+    except KeyboardInterrupt:
+        LOGGER.info("Forcing exit.")
+        executor.shutdown(wait=False, cancel_futures=True)
+        exit()
+    finally:
+        stop_reporting.set()
+        reporter.join()
+        LOGGER.info('Processed %(processed)d segments (%(failed)d failed)', _PROGRESS)
+        # Flush any log records still in the queue
+        log_listener.stop()
 
 
 if __name__ == '__main__':
@@ -4,17 +4,21 @@ class SubprocessError(Exception):
     when running a command line command with a subprocess.
     """
     def __init__(self, cmd, return_code, stdout, stderr, *args):
-        msg = 'Got non-zero exit code ({1}) from command "{0}": {2}'
-        if stderr.strip():
-            err_msg = stderr
-        else:
-            err_msg = stdout
-        msg = msg.format(cmd[0], return_code, err_msg)
         self.cmd = cmd
         self.cmd_return_code = return_code
         self.cmd_stdout = stdout
         self.cmd_stderr = stderr
-        super(SubprocessError, self).__init__(msg, *args)
+        super(SubprocessError, self).__init__(cmd, return_code, stdout, stderr, *args)
+
+    def __str__(self):
+        # Only build the message when it is actually used, since callers often
+        # just inspect the output
+        msg = 'Got non-zero exit code ({1}) from command "{0}": {2}'
+        if self.cmd_stderr.strip():
+            err_msg = self.cmd_stderr
+        else:
+            err_msg = self.cmd_stdout
+        return msg.format(self.cmd[0], self.cmd_return_code, err_msg)
 
 
 class FfmpegValidationError(Exception):
@@ -34,3 +38,31 @@ class FfmpegIncorrectDurationError(FfmpegValidationError):
         msg = "Output at {} was expected to be duration {} seconds, but got {} seconds"
         msg = msg.format(filepath, target_duration, actual_duration)
         super(FfmpegIncorrectDurationError, self).__init__( msg, *args)
+
+
+class SubsetFileError(Exception):
+    """
+    Exception object that is raised when a subset segments file is malformed.
+    """
+    def __init__(self, subset_path, line_num, line, *args):
+        self.subset_path = subset_path
+        self.line_num = line_num
+        self.line = line
+        msg = 'Encountered malformed segment in {} at line {}: {}'
+        msg = msg.format(subset_path, line_num, line)
+        super(SubsetFileError, self).__init__(msg, *args)
+
+
+class SegmentDownloadError(Exception):
+    """
+    Exception object that is raised when not all of the outputs of a segment
+    could be produced.
+    """
+    def __init__(self, ytid, ts_start, ts_end, filepaths, *args):
+        self.ytid = ytid
+        self.ts_start = ts_start
+        self.ts_end = ts_end
+        self.filepaths = filepaths
+        msg = 'Could not produce {} for video {} ({} - {})'
+        msg = msg.format(', '.join(filepaths), ytid, ts_start, ts_end)
+        super(SegmentDownloadError, self).__init__(msg, *args)
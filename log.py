@@ -1,5 +1,6 @@
 import logging
 import logging.handlers
+import queue
 
 
 def init_file_logger(logger, log_path=None):
@@ -43,4 +44,34 @@ def init_console_logger(logger, verbose=False):
         stream_handler.setLevel(logging.ERROR)
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
\ No newline at end of file
+    logger.addHandler(stream_handler)
+
+
+def init_queue_logger(logger):
+    """
+    Moves the handlers of a logger behind a queue.
+
+    Records are put on the queue by the logging threads, and a single listener
+    thread passes them to the original handlers. This way, worker threads never
+    wait on handler locks or on writes to the log file.
+
+    Args:
+        logger:  Logger object, with its handlers already initialized
+                 (Type: logging.Logger)
+
+    Returns:
+        listener:  Started listener. Call listener.stop() to flush any
+                   remaining records before exiting.
+                   (Type: logging.handlers.QueueListener)
+    """
+    log_queue = queue.Queue(-1)
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers,
+                                              respect_handler_level=True)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+
+    return listener
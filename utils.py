@@ -1,11 +1,18 @@
+import collections
+import errno
 import os
 import re
+import shutil
 import subprocess as sp
 
-from errors import SubprocessError
+from errors import SubprocessError, SubsetFileError
+
+# Number of lines of stderr kept from commands whose stdout is not captured
+MAX_STDERR_LINES = 256
 
 URL_PATTERN = re.compile(r'https?:\/\/(www\.)?[-a-zA-Z0-9@:%._\+~#=]{2,256}\.[a-z]{2,6}\b([-a-zA-Z0-9@:%_\+.~#?&//=]*)')
-HTTP_ERR_PATTERN = re.compile(r'Server returned (4|5)(X|[0-9])(X|[0-9])')
+# ffmpeg reports HTTP errors as e.g. '<url>: Server returned 404 Not Found'
+HTTP_ERR_PATTERN = re.compile(r'Server returned [45][X0-9]{2}', re.ASCII)
 
 
 def run_command(cmd, **kwargs):
@@ -16,25 +23,45 @@ def run_command(cmd, **kwargs):
         cmd:       List of strings used in the command
                    (Type: list[str])
 
-        **kwargs:  Keyword arguments to be passed to subprocess.Popen()
+        **kwargs:  Keyword arguments to be passed to subprocess.Popen(). stdout
+                   and stderr are captured unless redirected here, e.g. with
+                   stdout=subprocess.DEVNULL when the output is not needed.
+                   If only stderr is captured, just its last
+                   MAX_STDERR_LINES lines are kept.
+
+    The output is only decoded if the command fails, when it is attached to
+    the raised SubprocessError.
 
     Returns:
-        stdout:       stdout string produced by running command
-                      (Type: str)
+        stdout:       stdout produced by running command
+                      (Type: bytes)
 
-        stderr:       stderr string produced by running command
-                      (Type: str)
+        stderr:       stderr produced by running command
+                      (Type: bytes)
 
         return_code:  Exit/return code from running command
                       (Type: int)
     """
-    proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True, **kwargs)
-    stdout, stderr = proc.communicate()
+    kwargs.setdefault('stdout', sp.PIPE)
+    kwargs.setdefault('stderr', sp.PIPE)
+    proc = sp.Popen(cmd, **kwargs)
+    if kwargs['stdout'] != sp.PIPE and kwargs['stderr'] == sp.PIPE:
+        # With a single pipe there is no risk of deadlock, so read stderr
+        # line by line and only keep its tail, which is where errors end up
+        with proc.stderr:
+            stderr_lines = collections.deque(proc.stderr, maxlen=MAX_STDERR_LINES)
+        proc.wait()
+        stdout, stderr = b'', b''.join(stderr_lines)
+    else:
+        stdout, stderr = proc.communicate()
+        stdout, stderr = stdout or b'', stderr or b''
 
     return_code = proc.returncode
 
     if return_code != 0:
-        raise SubprocessError(cmd, return_code, stdout, stderr)
+        raise SubprocessError(cmd, return_code,
+                              stdout.decode('utf-8', 'replace'),
+                              stderr.decode('utf-8', 'replace'))
 
     return stdout, stderr, return_code
 
@@ -53,7 +80,8 @@ def is_url(path):
         is_url:  True, if path is a URL
                  (Type: bool)
     """
-    return bool(URL_PATTERN.match(path))
+    # Local paths are rejected without running the pattern
+    return path.startswith(('http://', 'https://')) and bool(URL_PATTERN.match(path))
 
 
 def get_filename(path):
@@ -89,8 +117,75 @@ def get_media_filename(ytid, ts_start, ts_end):
         media_filename:  Filename (without extension) for segment media file
                          (Type: str)
     """
+    # Times are truncated to milliseconds, which existing datasets are named by
     tms_start, tms_end = int(ts_start * 1000), int(ts_end * 1000)
-    return '{}_{}_{}'.format(ytid, tms_start, tms_end)
+    return f'{ytid}_{tms_start}_{tms_end}'
+
+
+def get_media_filepaths(data_dir, ytid, ts_start, ts_end, video_format='mp4',
+                        audio_format='flac'):
+    """
+    Get the paths to the video and audio files for a YouTube video segment
+
+    Video files are stored in <data_dir>/video and audio files are stored in
+    <data_dir>/audio.
+
+    Args:
+        data_dir:      Subset data directory
+                       (Type: str)
+
+        ytid:          YouTube ID of a video
+                       (Type: str)
+
+        ts_start:      Segment start time (in seconds)
+                       (Type: float or int)
+
+        ts_end:        Segment end time (in seconds)
+                       (Type: float or int)
+
+    Keyword Args:
+        video_format:  Video file extension
+                       (Type: str)
+
+        audio_format:  Audio file extension
+                       (Type: str)
+
+    Returns:
+        video_filepath:  Path to segment video file
+                         (Type: str)
+
+        audio_filepath:  Path to segment audio file
+                         (Type: str)
+    """
+    media_filename = get_media_filename(ytid, ts_start, ts_end)
+    video_filepath = os.path.join(data_dir, 'video', f'{media_filename}.{video_format}')
+    audio_filepath = os.path.join(data_dir, 'audio', f'{media_filename}.{audio_format}')
+    return video_filepath, audio_filepath
+
+
+def move_file(src_path, dst_path):
+    """
+    Move a file such that the destination never holds a partially written
+    file, even if the source is on a different filesystem.
+
+    Args:
+        src_path:  Path to file to move
+                   (Type: str)
+
+        dst_path:  Destination path
+                   (Type: str)
+    """
+    try:
+        os.replace(src_path, dst_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Copy next to the destination first, so that the final rename is
+        # atomic
+        tmp_path = dst_path + '.part'
+        shutil.copyfile(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+        os.remove(src_path)
 
 
 def get_subset_name(subset_path):
@@ -112,4 +207,45 @@ def get_subset_name(subset_path):
     if ext[1:].isdigit():
         subset_name, file_num = os.path.splitext(subset_name)
 
-    return subset_name
\ No newline at end of file
+    return subset_name
+
+
+def iter_subset_segments(subset_path):
+    """
+    Iterates over the segments listed in a subset segments file.
+
+    Only the first three columns (YouTube ID, start time and end time) are
+    parsed, so the quoted label column is never tokenized or decoded. Comment lines
+    (starting with '#') and blank lines are skipped, which means both the
+    original subset files and headerless split files are supported.
+
+    Args:
+        subset_path:  Path to subset segments file
+                      (Type: str)
+
+    Yields:
+        ytid:      YouTube ID of a video
+                   (Type: str)
+
+        ts_start:  Segment start time (in seconds)
+                   (Type: float)
+
+        ts_end:    Segment end time (in seconds)
+                   (Type: float)
+    """
+    # Read the file as bytes, since float() parses bytes directly and only the
+    # YouTube ID needs to be decoded
+    with open(subset_path, 'rb') as f:
+        for line_idx, line in enumerate(f):
+            if line[:1] == b'#' or not line.strip():
+                continue
+
+            fields = line.split(b',', 3)
+            try:
+                ytid = fields[0].decode('ascii')
+                ts_start, ts_end = float(fields[1]), float(fields[2])
+            except (IndexError, ValueError):
+                raise SubsetFileError(subset_path, line_idx + 1,
+                                      line.rstrip().decode('utf-8', 'replace'))
+
+            yield ytid, ts_start, ts_end
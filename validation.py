@@ -1,6 +1,12 @@
 import json
+import math
 import os.path
 import sox
+try:
+    import soundfile
+except (ImportError, OSError):
+    # OSError is raised if SoundFile is installed but libsndfile cannot be loaded
+    soundfile = None
 
 from errors import FfmpegValidationError, FfmpegIncorrectDurationError
 from utils import run_command
@@ -11,28 +17,132 @@ LOGGER = logging.getLogger('audiosetdl')
 LOGGER.setLevel(logging.DEBUG)
 
 TOL = 0.7   # allow 0.7s variation in length
+FLOAT_TOL = 1e-6    # tolerance for comparing other numeric fields
 
-def ffprobe(ffprobe_path, filepath):
+# Fields that are compared as numbers, since ffprobe reports them as strings
+NUMERIC_KEYS = frozenset(['sample_rate', 'channels', 'bitrate', 'num_samples',
+                          'width', 'height', 'nb_frames', 'bit_rate'])
+
+# Fields that ffprobe reports as '<numerator>/<denominator>' ratios
+RATE_KEYS = frozenset(['r_frame_rate', 'avg_frame_rate'])
+
+# Sample bit depths of the libsndfile subtypes that sox also reports
+SOUNDFILE_BIT_DEPTHS = {
+    'PCM_S8': 8,
+    'PCM_U8': 8,
+    'PCM_16': 16,
+    'PCM_24': 24,
+    'PCM_32': 32,
+}
+
+def parse_rate(rate):
+    """
+    Parse a rate reported by ffprobe, e.g. '30000/1001' or '30'
+
+    Args:
+        rate:  Rate, optionally given as a ratio string
+               (Type: str)
+
+    Returns:
+        rate:  Parsed rate
+               (Type: float)
+    """
+    num, _, den = str(rate).partition('/')
+    return float(num) / float(den) if den else float(num)
+
+
+def check_output_file(filepath):
+    """
+    Make sure an output file exists and is not empty, with a single stat call,
+    before spending a subprocess on inspecting it
+
+    Args:
+        filepath:  Path to output file
+                   (Type: str)
+    """
+    try:
+        file_size = os.stat(filepath).st_size
+    except OSError:
+        error_msg = 'Output file {} does not exist.'.format(filepath)
+        raise FfmpegValidationError(error_msg)
+
+    if file_size == 0:
+        error_msg = 'Output file {} is empty.'.format(filepath)
+        raise FfmpegValidationError(error_msg)
+
+
+def ffprobe(ffprobe_path, filepath, select_streams=None, stream_entries=None):
     """
     Run ffprobe to analyse audio or video file
 
     Args:
-        ffprobe_path:  Path to ffprobe executable
-                       (Type: str)
+        ffprobe_path:    Path to ffprobe executable
+                         (Type: str)
 
-        filepath:      Path to audio or video file to analyse
-                       (Type: str)
+        filepath:        Path to audio or video file to analyse
+                         (Type: str)
+
+    Keyword Args:
+        select_streams:  ffprobe stream specifier of the streams to report,
+                         e.g. 'v:0'. If None, all streams are reported.
+                         (Type: str or None)
+
+        stream_entries:  Stream fields to report. If None, the format and all
+                         stream fields are reported.
+                         (Type: iterable[str] or None)
 
     Returns:
         output:  JSON object returned by ffprobe
                  (Type: JSON comptiable dict)
     """
-    cmd_format = '{} -v quiet -print_format json -show_format -show_streams {}'
-    cmd = cmd_format.format(ffprobe_path, filepath).split()
+    # Build the argument list directly, so that paths with spaces are passed
+    # through intact
+    cmd = [ffprobe_path, '-v', 'quiet', '-threads', '0', '-print_format', 'json']
+    if select_streams:
+        cmd += ['-select_streams', select_streams]
+    if stream_entries:
+        cmd += ['-show_entries', 'stream=' + ','.join(stream_entries)]
+    else:
+        cmd += ['-show_format', '-show_streams']
+    cmd.append(filepath)
     stdout, stderr, retcode = run_command(cmd)
     return json.loads(stdout)
 
 
+def get_audio_info(audio_filepath):
+    """
+    Read the header of an audio file.
+
+    The header is read in-process with soundfile if it is installed and
+    supports the file, which avoids spawning sox for every file. Otherwise,
+    sox is used.
+
+    Args:
+        audio_filepath:  Path to audio file
+                         (Type: str)
+
+    Returns:
+        audio_info:  Audio info, with the same keys as sox.file_info.info()
+                     (Type: dict[str, *])
+    """
+    if soundfile is not None:
+        try:
+            sf_info = soundfile.info(audio_filepath)
+        except RuntimeError:
+            sf_info = None
+        if sf_info is not None and sf_info.subtype in SOUNDFILE_BIT_DEPTHS:
+            return {
+                'bitrate': SOUNDFILE_BIT_DEPTHS[sf_info.subtype],
+                'channels': sf_info.channels,
+                'duration': sf_info.duration,
+                'encoding': sf_info.format,
+                'num_samples': sf_info.frames,
+                'sample_rate': float(sf_info.samplerate)
+            }
+
+    return sox.file_info.info(audio_filepath)
+
+
 def validate_audio(audio_filepath, audio_info, end_past_video_end=False):
     """
     Take audio file and sanity check basic info.
@@ -59,39 +169,30 @@ def validate_audio(audio_filepath, audio_info, end_past_video_end=False):
         check_passed:  True if sanity check passed
                        (Type: bool)
     """
-    if not os.path.exists(audio_filepath):
-        error_msg = 'Output file {} does not exist.'.format(audio_filepath)
-        raise FfmpegValidationError(error_msg)
+    check_output_file(audio_filepath)
 
-    sox_info = sox.file_info.info(audio_filepath)
+    sox_info = get_audio_info(audio_filepath)
 
     # If duration specifically doesn't match, catch that separately so we can
     # retry with a different duration
     target_duration = audio_info['duration']
     actual_duration = sox_info['num_samples'] / audio_info['sample_rate']
-    if target_duration != actual_duration:
-        #if not(end_past_video_end and actual_duration < target_duration):
-        if actual_duration < (target_duration - TOL) or actual_duration > (target_duration+TOL):
-            raise FfmpegIncorrectDurationError(audio_filepath, target_duration,
-                                               actual_duration)
+    #if not(end_past_video_end and actual_duration < target_duration):
+    if not math.isclose(actual_duration, target_duration, rel_tol=0, abs_tol=TOL):
+        raise FfmpegIncorrectDurationError(audio_filepath, target_duration,
+                                           actual_duration)
     for k, v in audio_info.items():
         if k == 'duration': #and (end_past_video_end and actual_duration < target_duration):
             continue
 
-        output_v = sox_info[k]
+        output_v = sox_info.get(k)
+        if k in NUMERIC_KEYS and output_v is not None:
+            matches = math.isclose(float(v), float(output_v), rel_tol=FLOAT_TOL,
+                                   abs_tol=FLOAT_TOL)
+        else:
+            matches = v == output_v
 
-        try:
-            v = float(v)
-        except ValueError:
-            #LOGGER.warning("Could not convert audio info value {} for key {}".format(v, k))
-            pass
-        try:
-            output_v = float(output_v)
-        except ValueError:
-            #LOGGER.warning("Could not convert sox info value {} for key {}".format(output_v, k))
-            pass
-
-        if v != output_v:
+        if not matches:
             error_msg = 'Output audio {} should have {} = {}, but got {}.'.format(audio_filepath, k, v, output_v)
             raise FfmpegValidationError(error_msg)
 
@@ -110,55 +211,66 @@ def validate_video(video_filepath, ffprobe_path, video_info, end_past_video_end=
         video_info:      Video info dictionary
                          (Type: str)
     """
-    ffprobe_info = ffprobe(ffprobe_path, video_filepath)
+    check_output_file(video_filepath)
+
+    # Only have ffprobe report the first video stream, and the fields of it
+    # that are checked below
+    stream_entries = {'r_frame_rate', 'avg_frame_rate', 'duration', 'nb_frames'}
+    stream_entries.update(video_info)
+    ffprobe_info = ffprobe(ffprobe_path, video_filepath, select_streams='v:0',
+                           stream_entries=sorted(stream_entries))
     if not ffprobe_info:
         error_msg = 'Could not analyse {} with ffprobe'
         raise FfmpegValidationError(error_msg.format(video_filepath))
 
-    # Get the video stream data
+    # Get the video stream data. Only the first video stream was selected, so
+    # it is the only stream reported
     if not ffprobe_info.get('streams'):
         error_msg = '{} has no video streams!'
         raise FfmpegValidationError(error_msg.format(video_filepath))
-    ffprobe_info = next(stream for stream in ffprobe_info['streams'] if stream['codec_type'] == 'video')
+    ffprobe_info = ffprobe_info['streams'][0]
 
     # If duration specifically doesn't match, catch that separately so we can
     # retry with a different duration
     target_duration = video_info['duration']
     try:
-        actual_fr_ratio = ffprobe_info.get('r_frame_rate',
-                                           ffprobe_info['avg_frame_rate'])
-        fr_num, fr_den = actual_fr_ratio.split('/')
-        actual_framerate = float(fr_num) / float(fr_den)
-    except KeyError:
+        actual_framerate = parse_rate(ffprobe_info.get('r_frame_rate')
+                                      or ffprobe_info['avg_frame_rate'])
+    except (KeyError, ValueError, ZeroDivisionError):
         error_msg = 'Could not get frame rate from {}'
         raise FfmpegValidationError(error_msg.format(video_filepath))
-    actual_duration = float(ffprobe_info['nb_frames']) / actual_framerate
-    if target_duration != actual_duration:
-        #if not(end_past_video_end and actual_duration < (target_duration-TOL)):
-        if actual_duration < (target_duration - TOL) or actual_duration > (target_duration+TOL):
-            raise FfmpegIncorrectDurationError(video_filepath, target_duration,
-                                               actual_duration)
+    # Read the duration from the stream header, and only fall back to counting
+    # frames if the container does not provide it
+    if 'duration' in ffprobe_info:
+        actual_duration = float(ffprobe_info['duration'])
+    else:
+        actual_duration = float(ffprobe_info['nb_frames']) / actual_framerate
+    #if not(end_past_video_end and actual_duration < (target_duration-TOL)):
+    if not math.isclose(actual_duration, target_duration, rel_tol=0, abs_tol=TOL):
+        raise FfmpegIncorrectDurationError(video_filepath, target_duration,
+                                           actual_duration)
 
     for k, v in video_info.items():
         if k == 'duration': # and (end_past_video_end and actual_duration < target_duration):
             continue
 
-        output_v = ffprobe_info[k]
-
+        output_v = ffprobe_info.get(k)
         # Convert numeric types to float, since we may get strings from ffprobe
-        try:
-            v = float(v)
-        except ValueError:
-            #LOGGER.warning("Could not convert video info value {} for key {}".format(v, k))
-            pass
-        try:
-            output_v = float(output_v)
-        except ValueError:
-            #LOGGER.warning("Could not convert ffprobe value {} for key {}".format(output_v, k))
-            pass
+        matches = v == output_v
+        if not matches and output_v is not None:
+            try:
+                if k in RATE_KEYS:
+                    # Equal rates may be given as different ratios
+                    matches = math.isclose(parse_rate(v), parse_rate(output_v),
+                                           rel_tol=FLOAT_TOL, abs_tol=FLOAT_TOL)
+                elif k in NUMERIC_KEYS:
+                    matches = math.isclose(float(v), float(output_v),
+                                           rel_tol=FLOAT_TOL, abs_tol=FLOAT_TOL)
+            except (ValueError, ZeroDivisionError):
+                # ffprobe reports unknown values as 'N/A' (or '0/0')
+                pass
 
-        # if duration, and within tolerance, then short circuit the v!=output_v test
-        if v != output_v:
+        if not matches:
             error_msg = 'Output video {} should have {} = {}, but got {}.'.format(video_filepath, k, v, output_v)
             raise FfmpegValidationError(error_msg)
 